@@ -6,16 +6,24 @@
 # version ='0.2'
 # ---------------------------------------------------------------------------
 """ This script cross-checks the NRAU-Baltic logs in CW and PH categories 
-    Usage: python check.py > results.csv
+    Usage: python check.py [--no-cache] > results.csv
 
     Logs should be placed in folders "CW" and "PH" respectively
 """
 # ---------------------------------------------------------------------------
 
+import io
 import os
+import csv
 import sys
 import json
+import pickle
+import argparse
+from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from pyhamtools import LookupLib, Callinfo
 from cabrillo.parser import QSO, parse_log_file
 
@@ -26,56 +34,147 @@ NUM_FILES = 0
 NUM_MISTAKES = 0
 LOG_EXT = ".txt"
 UBN_EXT = ".ubn"
+CACHE_EXT = ".pkl"
+CACHE_DIR = "./.cache/"
+USE_CACHE = True
 MAX_MINUTE_DELTA = 5
 PH_CONTEST_START = "2022-01-09 06:30:00"
 CW_CONTEST_START = "2022-01-09 09:00:00"
-shadow_stations = {}
+CONTEST_DURATION = timedelta(hours=2)
+PH_START = datetime.strptime(PH_CONTEST_START, "%Y-%m-%d %H:%M:%S")
+CW_START = datetime.strptime(CW_CONTEST_START, "%Y-%m-%d %H:%M:%S")
+PH_END = PH_START + CONTEST_DURATION
+CW_END = CW_START + CONTEST_DURATION
+# contest band segments in kHz, whole-band entries (3500, 7000) included
+CW_FREQS = frozenset([3500, 7000, *range(3510, 3561), *range(7010, 7061)])
+PH_FREQS = frozenset(
+    [
+        3500,
+        7000,
+        *range(3600, 3651),
+        *range(3700, 3776),
+        *range(7050, 7101),
+        *range(7130, 7201),
+    ]
+)
+shadow_stations = defaultdict(dict)
+_contest = {}
+_qso_index = {}
+_countries = {}
+
+cic = None
+
+
+def callinfo():
+    # the countryfile is only loaded on first use, so pool workers that get
+    # every country handed over by lookup_countries() never load it:
+    global cic
+    if cic is None:
+        cic = Callinfo(LookupLib(lookuptype="countryfile"))
+    return cic
+
+
+def country_of(call):
+    if call not in _countries:
+        try:
+            _countries[call] = callinfo().get_country_name(call)
+        except KeyError:
+            _countries[call] = None
+    if _countries[call] is None:
+        raise KeyError(call)
+    return _countries[call]
+
+
+def lookup_countries(contest):
+    # resolve every worked callsign once, before the logs are handed out
+    # to the workers, so they don't repeat the same prefix lookups:
+    for qsos in contest.values():
+        for qso in qsos:
+            if qso.dx_call in _countries:
+                continue
+            try:
+                country_of(qso.dx_call)
+            except KeyError:
+                pass
+    return _countries
+
 
-my_lookuplib = LookupLib(lookuptype="countryfile")
-cic = Callinfo(my_lookuplib)
+@lru_cache(maxsize=None)
+def counties_of(call):
+    return counties[country_of(call)]
 
 
 def read_counties():
-    county_file = open("counties.json")
-    data = json.load(county_file)
-    county_file.close()
-    return data
+    with open("counties.json") as county_file:
+        data = json.load(county_file)
+    return {country: frozenset(codes) for country, codes in data.items()}
+
+
+def load_log(path):
+    # parsed logs are pickled into CACHE_DIR and reused while the source file
+    # keeps the exact mtime and size it had when it was parsed:
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cache = os.path.join(
+        CACHE_DIR, os.path.normpath(path).replace(os.sep, "_") + CACHE_EXT
+    )
+    if USE_CACHE and os.path.exists(cache):
+        try:
+            with open(cache, "rb") as cache_file:
+                cached_stamp, cab = pickle.load(cache_file)
+            if cached_stamp == stamp:
+                return cab
+        except (
+            pickle.UnpicklingError,
+            EOFError,
+            AttributeError,
+            TypeError,
+            ValueError,
+        ):
+            # unreadable or outdated cache, parse the log again
+            pass
+    cab = parse_log_file(path, ignore_unknown_key=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache + ".tmp", "wb") as cache_file:
+        pickle.dump((stamp, cab), cache_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(cache + ".tmp", cache)
+    return cab
 
 
 def read_logs(folder):
     global NUM_FILES, NUM_QSO
     _ret = {}
     _meta = {}
-    files = os.listdir(folder)
-    for file in files:
-        if file.endswith(LOG_EXT):
-            cab = parse_log_file(folder + file, ignore_unknown_key=True)
-            _ret[cab.callsign] = cab.qso
-            checklog = "N"
-            power = "HIGH"
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith(LOG_EXT):
+                continue
+            cab = load_log(entry.path)
+            # callsigns are dict keys on every lookup, intern them so equal
+            # calls compare by identity:
+            callsign = sys.intern(cab.callsign)
+            for qso in cab.qso:
+                qso.de_call = sys.intern(qso.de_call)
+                qso.dx_call = sys.intern(qso.dx_call)
+            _ret[callsign] = cab.qso
+            category = getattr(cab, "category", None) or ""
+            operator = getattr(cab, "category_operator", None) or ""
+
+            power = getattr(cab, "category_power", None)
+            if power is None:
+                power = "HIGH"
+            if "MULTI" in category or operator == "MULTI-OP":
+                power = "MULTI"
+            elif "LOW" in category or "LP" in category:
+                power = "LOW"
+            elif "HIGH" in category or "HP" in category:
+                power = "HIGH"
 
-            if hasattr(cab, "category_power") and cab.category_power is not None:
-                power = cab.category_power
-
-            if hasattr(cab, "category"):
-                if cab.category.__contains__("HIGH") or cab.category.__contains__("HP"):
-                    power = "HIGH"
-                if cab.category.__contains__("LOW") or cab.category.__contains__("LP"):
-                    power = "LOW"
-                if cab.category.__contains__("CHECKLOG"):
-                    checklog = "Y"
-
-            if hasattr(cab, "category"):
-                if cab.category.__contains__("MULTI"):
-                    power = "MULTI"
-
-            if hasattr(cab, "category_operator"):
-                if cab.category_operator == "MULTI-OP":
-                    power = "MULTI"
-                if cab.category_operator == "CHECKLOG":
-                    checklog = "Y"
+            checklog = "N"
+            if "CHECKLOG" in category or operator == "CHECKLOG":
+                checklog = "Y"
 
-            _meta[cab.callsign] = dict(power=power, checklog=checklog)
+            _meta[callsign] = dict(power=power, checklog=checklog)
 
             if len(cab.qso) == 0:
                 print("No QSO found")
@@ -85,17 +184,22 @@ def read_logs(folder):
     return _ret, _meta
 
 
-def find_qso(contest, call, dx, band, occurence=1):
-    try:
-        found = 0
-        log = contest[call]
-        for q in log:
-            if q.dx_call == dx and q.freq[0] == band:
-                found += 1
-                if found == occurence:
-                    return q
-    except KeyError:
-        return False
+def index_qsos(contest):
+    _index = {}
+    for call, qsos in contest.items():
+        _index[call] = {}
+        for q in qsos:
+            _index[call].setdefault((q.dx_call, q.freq[0]), []).append(q)
+    return _index
+
+
+def find_qsos(qso_index, call, dx, band):
+    return qso_index.get(call, {}).get((dx, band), ())
+
+
+def find_qso(qso_index, call, dx, band):
+    candidates = find_qsos(qso_index, call, dx, band)
+    return candidates[0] if candidates else False
 
 
 def match_exch(my_qso, other_qso, log):
@@ -106,6 +210,9 @@ def match_exch(my_qso, other_qso, log):
     # my rx, other tx
     my_rx_exch = my_qso.dx_exch
     other_tx_exch = other_qso.de_exch
+    # fast path, the exchange was copied exactly as sent:
+    if my_rx_exch == other_tx_exch and len(my_tx_exch) == len(my_rx_exch) == 3:
+        return 2
     # match RST:
     if len(my_tx_exch) != 3:
         log.write("0\t(Incomplete TX message: {:s})".format(str(my_tx_exch)))
@@ -152,22 +259,18 @@ def match_time(date1, date2):
 
 
 def match_time_window(date):
-    global PH_CONTEST_START, CW_CONTEST_START
-    ph_time = datetime.strptime(PH_CONTEST_START, "%Y-%m-%d %H:%M:%S")
-    cw_time = datetime.strptime(CW_CONTEST_START, "%Y-%m-%d %H:%M:%S")
-    return (ph_time <= date < ph_time + timedelta(hours=2)) or (
-        cw_time <= date < cw_time + timedelta(hours=2)
-    )
+    return PH_START <= date < PH_END or CW_START <= date < CW_END
 
 
-def match_nrau(contest, my_qso, other_callsign, log, run=1):
+def match_nrau(qso_index, my_qso, other_callsign, log):
     my_freq = int(my_qso.freq)
-    if not other_callsign in contest:
+    band = my_qso.freq[0]
+    if other_callsign not in qso_index:
         if shadow_stations[other_callsign][my_qso.mo + "_count"] >= 10:
-            if my_qso.dx_exch[2] not in counties[cic.get_country_name(my_qso.dx_call)]:
+            if my_qso.dx_exch[2] not in counties_of(my_qso.dx_call):
                 log.write(
                     "0\t(No county {:s} in {:s})".format(
-                        my_qso.dx_exch[2], cic.get_country_name(my_qso.dx_call)
+                        my_qso.dx_exch[2], country_of(my_qso.dx_call)
                     )
                 )
                 return 0
@@ -177,31 +280,19 @@ def match_nrau(contest, my_qso, other_callsign, log, run=1):
             log.write("0\t(Log not received from {:s})".format(other_callsign))
             return 0
 
-    other_qso = find_qso(contest, other_callsign, my_qso.de_call, my_qso.freq[0], run)
+    candidates = find_qsos(qso_index, other_callsign, my_qso.de_call, band)
 
     # TODO: check for similar time/exchange for errors in dx call
     # (this does not impact the result, just explains the case in UBN)
-    if not other_qso:
+    if not candidates:
         log.write("0\t(QSO not found in {:s}'s log)".format(other_callsign))
         return 0
 
-    if my_qso.mo == "CW" and not (
-        (my_freq >= 3510 and my_freq <= 3560)
-        or my_freq == 3500
-        or (my_freq >= 7010 and my_freq <= 7060)
-        or my_freq == 7000
-    ):
+    if my_qso.mo == "CW" and my_freq not in CW_FREQS:
         log.write("0\t(CW QSO frequency {:d} out of contest band)".format(my_freq))
         return 0
 
-    if my_qso.mo == "PH" and not (
-        (my_freq >= 3600 and my_freq <= 3650)
-        or (my_freq >= 3700 and my_freq <= 3775)
-        or my_freq == 3500
-        or (my_freq >= 7050 and my_freq <= 7100)
-        or (my_freq >= 7130 and my_freq <= 7200)
-        or my_freq == 7000
-    ):
+    if my_qso.mo == "PH" and my_freq not in PH_FREQS:
         log.write("0\t(PH QSO frequency {:d} out of contest band)".format(my_freq))
         return 0
 
@@ -209,157 +300,193 @@ def match_nrau(contest, my_qso, other_callsign, log, run=1):
         log.write("0\t(QSO logged outside contest time)".format(my_qso.date))
         return 0
 
-    if not match_time(my_qso.date, other_qso.date):
-        # here check for possible dupes or repeated qsos
-        next_qso = find_qso(
-            contest, other_callsign, my_qso.de_call, my_qso.freq[0], run + 1
+    # here check for possible dupes or repeated qsos
+    for other_qso in candidates:
+        if match_time(my_qso.date, other_qso.date):
+            # final exchange check:
+            return match_exch(my_qso, other_qso, log)
+
+    log.write(
+        "0\t(Time differs: {:s}, {:s})".format(
+            str(my_qso.date), str(candidates[0].date)
         )
-        if next_qso:
-            next_score = match_nrau(contest, my_qso, other_callsign, log, run + 1)
-            if next_score > 0:
-                return next_score
-        else:
-            log.write(
-                "0\t(Time differs: {:s}, {:s})".format(
-                    str(my_qso.date), str(other_qso.date)
-                )
-            )
-            return 0
+    )
+    return 0
+
+
+def init_worker(contest, qso_index, countries, shadow, county_data):
+    global _contest, _qso_index, shadow_stations, counties
+    _contest = contest
+    _qso_index = qso_index
+    _countries.update(countries)
+    shadow_stations = shadow
+    counties = county_data
+
+
+def check_participant(filepath, call, meta):
+    qsos = _contest[call]
+    result = dict(
+        call=call,
+        mode=qsos[0].mo,
+        qso_count_80m=0,
+        qso_count_40m=0,
+        points_80m=0,
+        points_40m=0,
+        mults_80m=set(),
+        mults_40m=set(),
+        score=0,
+        power=meta["power"],
+        county=qsos[0].de_exch[2],
+        checklog=meta["checklog"],
+    )
 
-    # final exchange check:
-    return match_exch(my_qso, other_qso, log)
+    mistakes = 0
+    checklog = meta["checklog"] == "Y"
+    log = io.StringIO()
+    for qso in qsos:
+        dx_call, band = qso.dx_call, qso.freq[0]
+        log.write(str(qso) + "\t")
+        points = match_nrau(_qso_index, qso, dx_call, log)
+        if points == 2:
+            log.write("2")
+        if points > 0:
+            county = qso.dx_exch[2]
+            # checklogs are not ranked, don't track multipliers for them:
+            mult_ok = not checklog
+
+            if points == 1 and mult_ok:
+                # check if mult is ok in partial qso:
+                if county not in counties_of(dx_call):
+                    mult_ok = False
+                # do not issue multiplier on bad rx
+                other_qso = find_qso(_qso_index, dx_call, qso.de_call, band)
+                if other_qso and other_qso.de_exch[2] != county:
+                    mult_ok = False
+
+            if band == "7":
+                result["qso_count_40m"] += 1
+                result["points_40m"] += points
+                if mult_ok and county not in result["mults_40m"]:
+                    result["mults_40m"].add(county)
+                    log.write("\t+{:s}".format(county))
+            elif band == "3":
+                result["qso_count_80m"] += 1
+                result["points_80m"] += points
+                if mult_ok and county not in result["mults_80m"]:
+                    result["mults_80m"].add(county)
+                    log.write("\t+{:s}".format(county))
+
+        if points < 2:
+            mistakes += 1
+            qso.valid = False
+        log.write("\n")
+    with open(filepath + call + UBN_EXT, "w") as ubn_file:
+        ubn_file.write(log.getvalue())
+    return call, result, mistakes
 
 
 def loop_all(filepath):
     global NUM_MISTAKES, shadow_stations
     results = {}
     contest, metadata = read_logs(filepath)
+    qso_index = index_qsos(contest)
+    countries = lookup_countries(contest)
 
     for call, qsos in contest.items():
         for qso in qsos:
-            if not qso.dx_call in contest:
-                if not qso.dx_call in shadow_stations:
-                    shadow_stations[qso.dx_call] = {}
-                if not qso.mo + "_count" in shadow_stations[qso.dx_call]:
-                    shadow_stations[qso.dx_call][qso.mo + "_count"] = 0
-                if not qso.mo in shadow_stations[qso.dx_call]:
-                    shadow_stations[qso.dx_call][qso.mo] = []
-                shadow_stations[qso.dx_call][qso.mo].append(qso.de_call)
-                shadow_stations[qso.dx_call][qso.mo + "_count"] += 1
+            if qso.dx_call in contest:
+                continue
+            shadow = shadow_stations[qso.dx_call]
+            shadow.setdefault(qso.mo, []).append(qso.de_call)
+            shadow[qso.mo + "_count"] = shadow.get(qso.mo + "_count", 0) + 1
+
+    # each participant is checked independently against the shared read-only
+    # index, so spread the work across all cores:
+    with ProcessPoolExecutor(
+        initializer=init_worker,
+        initargs=(contest, qso_index, countries, shadow_stations, counties),
+    ) as executor:
+        for call, result, mistakes in executor.map(
+            check_participant,
+            repeat(filepath),
+            contest,
+            [metadata[call] for call in contest],
+        ):
+            results[call] = result
+            NUM_MISTAKES += mistakes
+    return results
 
-    for call, qsos in contest.items():
-        # print("{:s}".format(call), end=", ", flush=True)
-        results[call] = dict(
-            call=call,
-            mode=qsos[0].mo,
-            qso_count_80m=0,
-            qso_count_40m=0,
-            points_80m=0,
-            points_40m=0,
-            mults_80m=[],
-            mults_40m=[],
-            score=0,
-            power=metadata[call]["power"],
-            county=qsos[0].de_exch[2],
-            checklog=metadata[call]["checklog"],
-        )
 
-        log = open(filepath + call + UBN_EXT, "w+")
-        for qso in qsos:
-            log.write(str(qso) + "\t")
-            points = match_nrau(contest, qso, qso.dx_call, log)
-            if points == 2:
-                log.write("2")
-            if points > 0:
-                county = qso.dx_exch[2]
-                mult_ok = True
-
-                if points == 1:
-                    country = cic.get_country_name(qso.dx_call)
-                    # check if mult is ok in partial qso:
-                    if county not in counties[country]:
-                        mult_ok = False
-                    # do not issue multiplier on bad rx
-                    other_qso = find_qso(contest, qso.dx_call, qso.de_call, qso.freq[0])
-                    if other_qso and other_qso.de_exch[2] != qso.dx_exch[2]:
-                        mult_ok = False
-
-                if qso.freq[0] == "7":
-                    results[call]["qso_count_40m"] += 1
-                    results[call]["points_40m"] += points
-                    if mult_ok and county not in results[call]["mults_40m"]:
-                        results[call]["mults_40m"].append(county)
-                        log.write("\t+{:s}".format(county))
-                if qso.freq[0] == "3":
-                    results[call]["qso_count_80m"] += 1
-                    results[call]["points_80m"] += points
-                    if mult_ok and county not in results[call]["mults_80m"]:
-                        results[call]["mults_80m"].append(county)
-                        log.write("\t+{:s}".format(county))
-
-            if points < 2:
-                NUM_MISTAKES += 1
-                qso.valid = False
-            log.write("\n")
-        log.close()
-    return results
+CSV_HEADER = [
+    "MODE",
+    "CALL",
+    "QSO_COUNT_80m",
+    "QSO_COUNT_40m",
+    "POINT_80m",
+    "POINT_40m",
+    "MULT_80m",
+    "MULT_40m",
+    "SCORE",
+    "POWER",
+    "COUNTY",
+    "CHECKLOG",
+]
+
+
+def csv_writer():
+    return csv.writer(sys.stdout, lineterminator="\n")
 
 
 def print_csv_header():
-    print(
-        "MODE,"
-        "CALL,"
-        "QSO_COUNT_80m,"
-        "QSO_COUNT_40m,"
-        "POINT_80m,"
-        "POINT_40m,"
-        "MULT_80m,"
-        "MULT_40m,"
-        "SCORE,"
-        "POWER,"
-        "COUNTY,"
-        "CHECKLOG"
-    )
+    csv_writer().writerow(CSV_HEADER)
 
 
 def results_to_csv(results):
-    for item in results:
-        participant = results[item]
-        print(
-            "{:s},{:s},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:s},{:s},{:s}".format(
-                participant["mode"],
-                participant["call"],
-                participant["qso_count_80m"],
-                participant["qso_count_40m"],
-                participant["points_80m"],
-                participant["points_40m"],
-                len(participant["mults_80m"]),
-                len(participant["mults_40m"]),
-                (participant["points_80m"] + participant["points_40m"])
-                * (len(participant["mults_80m"]) + len(participant["mults_40m"])),
-                participant["power"],
-                participant["county"],
-                participant["checklog"],
-            )
+    csv_writer().writerows(
+        (
+            participant["mode"],
+            participant["call"],
+            participant["qso_count_80m"],
+            participant["qso_count_40m"],
+            participant["points_80m"],
+            participant["points_40m"],
+            len(participant["mults_80m"]),
+            len(participant["mults_40m"]),
+            (participant["points_80m"] + participant["points_40m"])
+            * (len(participant["mults_80m"]) + len(participant["mults_40m"])),
+            participant["power"],
+            participant["county"],
+            participant["checklog"],
         )
+        for participant in results.values()
+    )
 
 
-cw_path = "./CW/"
-ph_path = "./PH/"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NRAU-Baltic log cross-checker")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="re-parse all logs, ignoring the cache in {:s}".format(CACHE_DIR),
+    )
+    args = parser.parse_args()
+    USE_CACHE = not args.no_cache
 
-counties = read_counties()
+    cw_path = "./CW/"
+    ph_path = "./PH/"
 
-cw_results = loop_all(cw_path)
-ph_results = loop_all(ph_path)
+    counties = read_counties()
 
+    cw_results = loop_all(cw_path)
+    ph_results = loop_all(ph_path)
 
-print_csv_header()
-results_to_csv(cw_results)
-results_to_csv(ph_results)
+    print_csv_header()
+    results_to_csv(cw_results)
+    results_to_csv(ph_results)
 
-print(
-    "{:d} QSO parsed ({:d} files), found {:d} mistakes".format(
-        NUM_QSO, NUM_FILES, NUM_MISTAKES
-    ),
-    file=sys.stderr,
-)
+    print(
+        "{:d} QSO parsed ({:d} files), found {:d} mistakes".format(
+            NUM_QSO, NUM_FILES, NUM_MISTAKES
+        ),
+        file=sys.stderr,
+    )